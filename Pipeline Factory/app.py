@@ -1,10 +1,21 @@
 import streamlit as st
-from typing import List
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from snowflake.snowpark import Session
 from snowflake.snowpark.context import get_active_session
 import re
+import time
+import hashlib
+import json
 import pandas as pd
 
+try:
+    import sqlglot
+    from sqlglot import exp
+except ImportError:  # optional; the lexical checks below are used without it
+    sqlglot = None
+
 # Inline config (replaces external config.py)
 DEFAULT_WAREHOUSE = "PIPELINE_WH"
 ALLOWED_TABLES: List[str] = []
@@ -13,97 +24,383 @@ CORTEX_MODEL = "mistral-large"
 FEW_SHOTS = [
     "You are a Snowflake SQL assistant. Only output a single SELECT query. Use fully qualified identifiers. Do not include comments or extra text."
 ]
+# Joined once so every COMPLETE call starts with a byte-identical prefix
+SYSTEM_PROMPT = "\n".join(FEW_SHOTS)
+
+MAX_GENERATION_ATTEMPTS = 3
+# Candidate queries requested from the first COMPLETE call
+CANDIDATES_PER_CALL = 3
+# System text for that call; SYSTEM_PROMPT's "single query, no extra text" would forbid the markers
+CANDIDATES_SYSTEM_PROMPT = (
+    "You are a Snowflake SQL assistant. Output only the requested candidate queries, each a single "
+    "SELECT wrapped in its [n] ... [END] markers. Use fully qualified identifiers. Do not include "
+    "comments or any other text."
+)
+
+# SHOW returns at most this many rows; a full page means the result may be truncated
+SHOW_ROW_LIMIT = 10000
+# SHOW COLUMNS reports internal type names; map them to the information_schema spelling
+_SHOW_TYPE_NAMES = {"FIXED": "NUMBER", "REAL": "FLOAT"}
 
 # Pipeline catalog location (fully qualified target for inserts)
 PIPELINE_CATALOG_DB = "TECHUP"
 PIPELINE_CATALOG_SCHEMA = "DEMO"
 
+# Exact-match cache of Cortex responses (see sql/CORTEX_PROMPT_CACHE.sql)
+PROMPT_CACHE_TTL_HOURS = 24
+
+# Precompiled patterns shared by the validation helpers
+# Language tag after an opening fence (```sql, ```snowflake, ...); a word other than sql only
+# counts when it ends the line, and SELECT/WITH are never taken for one
+_FENCE_TAG = r"(?:sql\b|(?!(?:select|with)\b)[A-Za-z]+(?=[ \t]*\r?\n))"
+_FENCE_TAG_RE = re.compile(_FENCE_TAG, re.I)
+_LEADING_FENCE_RE = re.compile(r"^```" + _FENCE_TAG + r"?\s*", re.I)
+_TRAILING_FENCE_RE = re.compile(r"```\s*$")
+_LEADING_SELECT_RE = re.compile(r"\s*(?:select|with)\b", re.I)
+
+# Error classes for the generation retry loop
+_MISSING_OBJECT_RE = re.compile(r"invalid identifier|does not exist or not authorized", re.I)
+_TRANSIENT_RE = re.compile(r"timeout|timed out|rate limit|too many requests|throttl", re.I)
+_CANDIDATE_RE = re.compile(r"\[(\d+)\]\s*(.*?)\s*\[END\]", re.S)
+# Some constructs that Dynamic Tables cannot refresh incrementally. Not exhaustive: when none
+# is found INCREMENTAL is requested, and RUN_PIPELINE_FACTORY retries without it if CREATE fails
+_FULL_REFRESH_RE = re.compile(
+    # Function names only count when called, so a column named random does not match
+    r"\b(except|intersect|minus|pivot|unpivot|sample|tablesample|(?:percentile_cont|percentile_disc|random|uuid_string)(?=\s*\())\b",
+    re.I,
+)
+
+if sqlglot is not None:
+    _QUERY_NODES = tuple(getattr(exp, n) for n in ("Select", "Union", "Intersect", "Except") if hasattr(exp, n))
+    _WRITE_NODES = tuple(
+        getattr(exp, n)
+        for n in ("Insert", "Update", "Delete", "Merge", "Create", "Drop", "Alter", "AlterTable",
+                  "TruncateTable", "Command", "Use", "Set", "Grant", "Copy")
+        if hasattr(exp, n)
+    )
+
+# Statement keywords that make a query non-read-only; matched as whole words outside quotes/comments
+PROHIBITED_WORDS = frozenset({
+    "insert", "update", "delete", "merge", "truncate",
+    "create", "alter", "drop", "grant", "revoke",
+    "copy", "call", "use", "set",
+})
+# Maps every ASCII character that cannot be part of an identifier to a space. "." is kept so
+# qualified names such as t.update or x.set stay one token and never match a keyword.
+_WORD_BREAKS = {c: " " for c in range(128) if not (chr(c).isalnum() or chr(c) in "_$.")}
+
 # Inline utils (replaces external snowflake_utils.py)
 def get_session() -> Session:
     return get_active_session()
 
+@lru_cache(maxsize=256)
 def normalize_sql_for_validation(sql_text: str) -> str:
     s = (sql_text or "").strip()
-    # Strip fenced code blocks like ```sql ... ```
-    s = re.sub(r"^```[a-zA-Z]*\s*", "", s)
-    s = re.sub(r"```\s*$", "", s)
-    s = s.strip()
+    # Strip fenced code blocks like ```sql ... ```; only the ends are inspected, so
+    # already-clean SQL is returned without another full copy
+    if s.startswith("```"):
+        s = _LEADING_FENCE_RE.sub("", s)
+    if s.endswith("```"):
+        s = _TRAILING_FENCE_RE.sub("", s).rstrip()
     # Allow a single trailing semicolon
     if s.endswith(";"):
-        s = s[:-1]
-    return s.strip()
+        s = s[:-1].rstrip()
+    return s
+
+def _has_prohibited_word(text: str) -> bool:
+    # translate/split run in C; whole words only, so longer names such as updated_at never match
+    return not PROHIBITED_WORDS.isdisjoint(text.lower().translate(_WORD_BREAKS).split())
+
+@lru_cache(maxsize=256)
+def scan_sql(sql_text: str) -> Tuple[str, bool, bool, bool, bool, str]:
+    """Single forward pass over fence-free SQL.
+
+    Returns (text without comments or trailing semicolon, has a bare semicolon,
+    starts with SELECT/WITH, uses a word from PROHIBITED_WORDS, parentheses balance,
+    text outside quotes and comments).
+    Quoted literals ('...' with '' or backslash escapes, $$...$$) and "identifiers" are
+    copied untouched; comments become a single space.
+    """
+    text = normalize_sql_for_validation(sql_text or "")
+    # Plain SQL (no quotes, comments or semicolons) needs no character walk at all
+    if ";" not in text and "'" not in text and '"' not in text and "--" not in text and "/*" not in text and "$$" not in text:
+        return (
+            text, False, bool(_LEADING_SELECT_RE.match(text, 0, 64)), _has_prohibited_word(text),
+            text.count("(") == text.count(")"), text,
+        )
+    out: List[str] = []
+    # Text outside quotes and comments, for the keyword check
+    bare: List[str] = []
+    semicolons = 0
+    i, start, seg, n = 0, 0, 0, len(text)
+    while i < n:
+        c = text[i]
+        if c == "'" or c == '"':
+            bare.append(text[seg:i])
+            # A doubled quote is an escape; jump from quote to quote until the closing one
+            j = i + 1
+            while True:
+                j = text.find(c, j)
+                if j == -1:
+                    j = n
+                    break
+                # Snowflake string literals also accept backslash escapes
+                k = j
+                while c == "'" and text[k - 1] == "\\" and k - 1 > i:
+                    k -= 1
+                if (j - k) % 2:
+                    j += 1
+                    continue
+                if text[j + 1:j + 2] == c:
+                    j += 2
+                    continue
+                j += 1
+                break
+            i = seg = j
+        elif c == "$" and text[i + 1:i + 2] == "$":
+            bare.append(text[seg:i])
+            j = text.find("$$", i + 2)
+            i = seg = n if j == -1 else j + 2
+        elif c == "-" and text[i + 1:i + 2] == "-":
+            out.append(text[start:i])
+            out.append(" ")
+            bare.append(text[seg:i])
+            j = text.find("\n", i)
+            i = start = seg = n if j == -1 else j
+        elif c == "/" and text[i + 1:i + 2] == "*":
+            out.append(text[start:i])
+            out.append(" ")
+            bare.append(text[seg:i])
+            j = text.find("*/", i + 2)
+            i = start = seg = n if j == -1 else j + 2
+        else:
+            if c == ";":
+                semicolons += 1
+            i += 1
+    out.append(text[start:])
+    bare.append(text[seg:])
+    clean = "".join(out).strip()
+    # A single trailing semicolon is allowed, even when followed by a comment
+    if clean.endswith(";") and semicolons:
+        clean = clean[:-1].rstrip()
+        semicolons -= 1
+    bare_text = " ".join(bare)
+    prohibited = _has_prohibited_word(bare_text)
+    return (
+        clean, semicolons > 0, bool(_LEADING_SELECT_RE.match(clean, 0, 64)), prohibited,
+        bare_text.count("(") == bare_text.count(")"), bare_text,
+    )
+
+@lru_cache(maxsize=256)
+def normalize_model_sql(text: str) -> str:
+    s = text or ""
+    # Take the first fenced block, if any; plain str.find beats a regex scan of the whole response
+    i = s.find("```")
+    if i != -1:
+        j = s.find("```", i + 3)
+        if j != -1:
+            s = s[i + 3:j]
+        elif not s[:i].strip():
+            # An opening fence that was never closed
+            s = s[i + 3:]
+        else:
+            i = -1
+    if i != -1:
+        m = _FENCE_TAG_RE.match(s)
+        if m:
+            s = s[m.end():]
+    # Peel whitespace and stray backticks in one pass per end instead of chained strips
+    s = s.strip(" \t\r\n`")
+    # Drop a leading language hint left over without its fence
+    if s[:3].lower() == "sql" and s[3:4].isspace():
+        s = s[3:].lstrip()
+    return s.rstrip(" \t\r\n;")
 
 def list_tables(session: Session, database: str, schema: str) -> List[str]:
-    rows = session.sql(
-        f"select table_name from {database}.information_schema.tables where table_schema = '{schema}' and table_type in ('BASE TABLE','VIEW') order by table_name"
-    ).collect()
-    return [f"{database}.{schema}.{r['TABLE_NAME']}" for r in rows]
-
-def get_databases(session: Session) -> List[str]:
+    # SHOW TERSE OBJECTS is a metadata call (no warehouse); information_schema is the fallback
     try:
-        rows = session.sql("show databases").collect()
-        # Snowpark SHOW returns lower-case keys typically, but guard for both
-        names = []
-        for r in rows:
-            if 'name' in r:
-                names.append(r['name'])
-            elif 'NAME' in r:
-                names.append(r['NAME'])
-        return sorted(names)
+        rows = session.sql(f"show terse objects in schema {_quote_identifier(database)}.{_quote_identifier(schema)}").collect()
+        if len(rows) < SHOW_ROW_LIMIT:
+            names = []
+            for r in rows:
+                d = r.as_dict()
+                if d.get("kind", d.get("KIND")) in ("TABLE", "VIEW"):
+                    names.append(d.get("name", d.get("NAME")))
+            prefix = f"{database}.{schema}."
+            return [prefix + name for name in sorted(names)]
     except Exception:
-        return []
+        pass
+    # The fully qualified name is assembled server-side, so rows map straight to options
+    rows = session.sql(
+        "select ? || '.' || table_schema || '.' || table_name from identifier(?) where table_schema = ? and table_type in ('BASE TABLE','VIEW') order by table_name",
+        params=[database, f"{database}.information_schema.tables", schema],
+    ).collect()
+    return [r[0] for r in rows]
 
-def get_schemas(session: Session, database: str) -> List[str]:
-    try:
-        rows = session.sql(f"show schemas in database {database}").collect()
-        names = []
-        for r in rows:
-            if 'name' in r:
-                names.append(r['name'])
-            elif 'NAME' in r:
-                names.append(r['NAME'])
-        return sorted(names)
-    except Exception:
-        return []
+def _schema_rows(rows) -> List[Tuple[str, str]]:
+    out: List[Tuple[str, str]] = []
+    for r in rows:
+        d = r.as_dict()
+        # SHOW output keys are usually lower-case, but guard for both
+        db = d.get("database_name", d.get("DATABASE_NAME"))
+        name = d.get("name", d.get("NAME"))
+        if db and name:
+            out.append((db, name))
+    return out
+
+def account_catalog(session: Session) -> Dict[str, List[str]]:
+    # One SHOW covers every database and schema, instead of SHOW DATABASES + SHOW SCHEMAS per database.
+    # Errors propagate so st.cache_data does not keep an empty catalog.
+    rows = session.sql("show schemas in account").collect()
+    if len(rows) < SHOW_ROW_LIMIT:
+        pairs = _schema_rows(rows)
+    else:
+        # A full page may be truncated; list schemas per database instead
+        databases = []
+        for r in session.sql("show databases").collect():
+            d = r.as_dict()
+            databases.append(d.get("name", d.get("NAME")))
+
+        def schemas_in(db):
+            try:
+                return _schema_rows(session.sql(f"show schemas in database {_quote_identifier(db)}").collect())
+            except Exception:
+                return []
+
+        # Per-database SHOWs are independent metadata round-trips, so overlap them
+        with ThreadPoolExecutor(max_workers=min(8, max(1, len(databases)))) as ex:
+            pairs = [p for found in ex.map(schemas_in, databases) for p in found]
+    catalog: Dict[str, List[str]] = {}
+    for db, name in pairs:
+        catalog.setdefault(db, []).append(name)
+    return {db: sorted(names) for db, names in sorted(catalog.items())}
+
+def sql_fingerprint(sql_text: str) -> str:
+    return hashlib.blake2b(sql_text.encode(), digest_size=16).hexdigest()
+
+def _quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+def _show_columns(session: Session, database: str, schema: str, tables: List[str]) -> Optional[Dict[str, str]]:
+    # SHOW is served from metadata without a warehouse; None means "use information_schema instead"
+    # SHOW is not a SELECT, so it is read with collect(); to_pandas() is not accepted everywhere
+    rows = session.sql(f"show columns in schema {_quote_identifier(database)}.{_quote_identifier(schema)}").collect()
+    if len(rows) >= SHOW_ROW_LIMIT:
+        return None
+    wanted = set(tables)
+    cols: Dict[str, List[str]] = {}
+    for r in rows:
+        d = r.as_dict()
+        tbl = d.get("table_name", d.get("TABLE_NAME"))
+        if tbl not in wanted:
+            continue
+        # data_type is a JSON document such as {"type":"FIXED","precision":38,...}
+        dtype = json.loads(d.get("data_type", d.get("DATA_TYPE")) or "{}").get("type", "")
+        cols.setdefault(tbl, []).append(f"{d.get('column_name', d.get('COLUMN_NAME'))}({_SHOW_TYPE_NAMES.get(dtype, dtype)})")
+    return {tbl: ", ".join(c) for tbl, c in cols.items()}
 
 def fetch_schema_card(session: Session, allowed_tables: List[str]) -> str:
-    lines: List[str] = []
+    by_schema: Dict[Tuple[str, str], List[str]] = {}
+    ordered: List[Tuple[str, str, str]] = []
     for full in allowed_tables:
         parts = [p.strip() for p in full.split('.')]
         if len(parts) != 3:
             continue
         db, sch, tbl = parts
-        cols = session.sql(
-            f"select column_name, data_type from {db}.information_schema.columns where table_schema = '{sch}' and table_name = '{tbl}' order by ordinal_position"
-        ).collect()
-        col_list = ", ".join([f"{c['COLUMN_NAME']}({c['DATA_TYPE']})" for c in cols])
-        lines.append(f"{db}.{sch}.{tbl}: {col_list}")
+        by_schema.setdefault((db, sch), []).append(tbl)
+        ordered.append((db, sch, tbl))
+
+    def show_or_none(item):
+        (db, sch), tables = item
+        try:
+            return _show_columns(session, db, sch, tables)
+        except Exception:
+            return None
+
+    # SHOW calls are independent round-trips; overlap them across schemas (map keeps input order)
+    groups = list(by_schema.items())
+    with ThreadPoolExecutor(max_workers=min(8, max(1, len(groups)))) as ex:
+        results = list(ex.map(show_or_none, groups))
+
+    cols_by_table: Dict[Tuple[str, str, str], str] = {}
+    fallback: Dict[str, List[Tuple[str, str]]] = {}
+    for ((db, sch), tables), found in zip(groups, results):
+        if found is None:
+            fallback.setdefault(db, []).extend((sch, tbl) for tbl in tables)
+            continue
+        for tbl, cols in found.items():
+            cols_by_table[(db, sch, tbl)] = cols
+
+    # Anything SHOW could not serve comes from one information_schema round-trip: a UNION ALL
+    # of one branch per database. Bound values keep the statement text stable for a given shape.
+    if fallback:
+        branches: List[str] = []
+        params: List[str] = []
+        for db, pairs in fallback.items():
+            in_list = ", ".join(["(?, ?)"] * len(pairs))
+            branches.append(
+                f"select ? as table_catalog, table_schema, table_name, column_name, data_type, ordinal_position from identifier(?) where (table_schema, table_name) in ({in_list})"
+            )
+            params += [db, f"{db}.information_schema.columns"] + [v for pair in pairs for v in pair]
+        df = session.sql(
+            " union all ".join(branches) + " order by table_catalog, table_schema, table_name, ordinal_position",
+            params=params,
+        ).to_pandas()
+        # Column labels are built column-wise; groupby keeps the ordinal order from the query
+        labels = df["COLUMN_NAME"] + "(" + df["DATA_TYPE"] + ")"
+        for key, cols in labels.groupby([df["TABLE_CATALOG"], df["TABLE_SCHEMA"], df["TABLE_NAME"]], sort=False):
+            cols_by_table[key] = ", ".join(cols)
+
+    lines = [f"{db}.{sch}.{tbl}: {cols_by_table.get((db, sch, tbl), '')}" for db, sch, tbl in ordered]
     return "\n".join(lines)
 
+class SqlAnalysis(NamedTuple):
+    clean: str
+    is_single_select: bool
+    is_read_only: bool
+    has_semicolon: bool
+    balanced_parens: bool
+    # Text outside quotes and comments, for keyword searches that must ignore literals
+    unquoted: str
+
+def _parse(sql_text: str):
+    # None means "no parser verdict, use the lexical checks"
+    if sqlglot is None:
+        return None
+    try:
+        return tuple(e for e in sqlglot.parse(sql_text, dialect="snowflake") if e is not None)
+    except Exception:
+        # The parser is best-effort: besides ParseError/TokenError, odd input can raise
+        # internal errors (e.g. AttributeError), and none of them may reach the page
+        return None
+
+@lru_cache(maxsize=128)
+def analyze_sql(sql_text: str) -> SqlAnalysis:
+    # One scan and at most one parse per distinct SQL text, shared by every check and rerun
+    clean, has_semicolon, starts_with_select, prohibited, balanced_parens, unquoted = scan_sql(sql_text)
+    tree = _parse(clean) if clean else None
+    if tree is not None:
+        single = len(tree) == 1 and isinstance(tree[0], _QUERY_NODES)
+        read_only = all(t.find(*_WRITE_NODES) is None for t in tree)
+    else:
+        # Only the head decides the statement kind; disallow semicolons outside of quotes
+        single = bool(clean) and starts_with_select and not has_semicolon
+        read_only = not prohibited
+    return SqlAnalysis(clean, single, read_only, has_semicolon, balanced_parens, unquoted)
+
 def is_single_select(sql_text: str) -> bool:
-    s = normalize_sql_for_validation(sql_text)
-    if not s:
-        return False
-    # Disallow any additional semicolons inside the text
-    if ';' in s:
-        return False
-    head = s.lstrip()[:6].upper()
-    return head.startswith("SELECT") or s.lstrip()[:4].upper() == "WITH"
+    return analyze_sql(sql_text).is_single_select
 
 def enforce_read_only(sql_text: str) -> bool:
-    s = " " + (sql_text or "").upper() + " "
-    prohibited = [
-        " INSERT ", " UPDATE ", " DELETE ", " MERGE ", " TRUNCATE ",
-        " CREATE ", " ALTER ", " DROP ", " GRANT ", " REVOKE ",
-        " COPY ", " CALL ", " USE ", " SET "
-    ]
-    return not any(tok in s for tok in prohibited)
-
-def preview_query(session: Session, sql_text: str, limit: int = PREVIEW_LIMIT):
-    clean = normalize_sql_for_validation(sql_text)
-    # Execute the exact SQL, only append a LIMIT for preview if not present
-    preview_sql = f"{clean} limit {limit}"
-    df = session.sql(preview_sql).to_pandas()
+    return analyze_sql(sql_text).is_read_only
+
+@lru_cache(maxsize=128)
+def incremental_blockers(sql_text: str) -> Tuple[str, ...]:
+    # Anything found here makes INCREMENTAL unlikely to work; string literals such as 'sample'
+    # and "RANDOM" identifiers are skipped by searching only the unquoted text
+    return tuple(sorted({m.group(1).upper() for m in _FULL_REFRESH_RE.finditer(analyze_sql(sql_text).unquoted)}))
+
+def _dedupe_columns(df: pd.DataFrame) -> pd.DataFrame:
     # Deduplicate column names for display while preserving order
     seen = {}
     new_cols = []
@@ -117,16 +414,235 @@ def preview_query(session: Session, sql_text: str, limit: int = PREVIEW_LIMIT):
     df.columns = new_cols
     return df
 
-def explain_query(session: Session, sql_text: str) -> str:
-    clean = normalize_sql_for_validation(sql_text)
-    rows = session.sql(f"EXPLAIN USING TEXT {clean}").collect()
+def _format_plan(rows) -> Tuple[str, str]:
     out: List[str] = []
+    top_operation = ""
     for r in rows:
+        d = r.as_dict()
+        # SHOW/EXPLAIN output keys are usually lower-case, but guard for both
+        operation = d.get("operation", d.get("OPERATION")) or ""
+        if not top_operation and operation != "GlobalStats":
+            top_operation = operation
+        fields = [d.get(k, d.get(k.upper())) for k in ("step", "id", "parent", "operation", "objects", "expressions")]
+        out.append("\t".join("" if f is None else str(f) for f in fields))
+    return "\n".join(out), top_operation
+
+def validate_sql(session: Session, sql_text: str, jobs: Optional[list] = None) -> dict:
+    # Submitted AsyncJobs are appended to jobs, if given, so a caller can cancel them
+    result = {
+        "is_select": is_single_select(sql_text),
+        "is_ro": enforce_read_only(sql_text),
+        "plan": None,
+        "explain_error": None,
+        "preview": None,
+        "preview_error": None,
+    }
+    clean = normalize_sql_for_validation(sql_text)
+    # EXPLAIN and the preview are independent round-trips, so submit both before waiting.
+    # The preview is only sent when the lexical checks already pass.
+    preview_job = None
+    try:
+        explain_job = session.sql(f"EXPLAIN USING TABULAR {clean}").collect_nowait()
+        if jobs is not None:
+            jobs.append(explain_job)
+        if result["is_select"] and result["is_ro"]:
+            # Wrap the comment-free text so a trailing -- comment cannot swallow ") limit N"
+            preview_job = session.sql(f"select * from ({analyze_sql(sql_text).clean}) limit {PREVIEW_LIMIT}").collect_nowait()
+            if jobs is not None:
+                jobs.append(preview_job)
+        result["plan"], top_operation = _format_plan(explain_job.result())
+    except Exception as e:
+        result["explain_error"] = str(e)
+        if preview_job is not None:
+            preview_job.cancel()
+        return result
+    # Snowflake's parse is authoritative: a single query statement plans to a top-level Result
+    result["is_select"] = result["is_select"] and top_operation == "Result"
+    if preview_job is None:
+        return result
+    if not result["is_select"]:
+        preview_job.cancel()
+        return result
+    try:
+        result["preview"] = _dedupe_columns(preview_job.result("pandas"))
+    except Exception as e:
+        result["preview_error"] = str(e)
+    return result
+
+def prompt_cache_key(model: str, system: str, prompt: str) -> str:
+    return hashlib.sha256(f"{model}|{system}|{prompt}".encode()).hexdigest()
+
+def cortex_complete(session: Session, model: str, system: str, prompt: str, use_cache: bool = True) -> str:
+    cache_fqn = f"{PIPELINE_CATALOG_DB}.{PIPELINE_CATALOG_SCHEMA}.CORTEX_PROMPT_CACHE"
+    # The cache is best-effort: a missing table or grant falls through to COMPLETE.
+    # use_cache=False forces a fresh call. Nothing is written here; only responses that
+    # produced a passing query are stored, by store_cortex_response.
+    if use_cache:
         try:
-            out.append(str(list(r.values())[0]))
+            rows = session.sql(
+                f"select response from {cache_fqn} where key = ? and created_at > dateadd('hour', ?, current_timestamp()) order by created_at desc limit 1",
+                params=[prompt_cache_key(model, system, prompt), -PROMPT_CACHE_TTL_HOURS],
+            ).collect()
+            if rows:
+                return rows[0][0]
         except Exception:
-            out.append(str(r))
-    return "\n".join(out)
+            pass
+
+    # Call Cortex via SQL function COMPLETE. Binding the text keeps a $$ in the prompt
+    # from ending the literal and gives every call the same statement text.
+    complete_sql = "select snowflake.cortex.complete(?, ?) as c"
+    params = [model, f"{system}\n\n{prompt}"]
+    return session.sql(complete_sql, params=params).collect()[0][0]
+
+def store_cortex_response(session: Session, model: str, system: str, prompt: str, response: str) -> None:
+    cache_fqn = f"{PIPELINE_CATALOG_DB}.{PIPELINE_CATALOG_SCHEMA}.CORTEX_PROMPT_CACHE"
+    key = prompt_cache_key(model, system, prompt)
+    try:
+        # Writes are rare (validated responses only), so pruning here keeps the table
+        # bounded without adding a statement to cache hits
+        session.sql(
+            f"delete from {cache_fqn} where key = ? or created_at <= dateadd('hour', ?, current_timestamp())",
+            params=[key, -PROMPT_CACHE_TTL_HOURS],
+        ).collect()
+        session.sql(
+            f"insert into {cache_fqn} (key, model, response) values (?, ?, ?)",
+            params=[key, model, response],
+        ).collect()
+    except Exception:
+        pass
+
+def build_prompt_prefix(schema_card: str, user_prompt: str) -> str:
+    # The output rules already lead every call via SYSTEM_PROMPT; only the scope and request go here
+    return f"""You may only reference these tables:
+{schema_card}
+
+User request:
+{user_prompt}
+"""
+
+def build_prompt(prompt_prefix: str, attempt_context: str = "", candidates: int = 1) -> str:
+    # Attempt-specific text only ever goes after the shared prefix
+    full_prompt = prompt_prefix
+    if candidates > 1:
+        markers = ", ".join(f"[{i}] ... [END]" for i in range(1, candidates + 1))
+        full_prompt += f"\nProduce {candidates} different candidate SELECT queries, each wrapped as {markers}.\n"
+    if attempt_context:
+        full_prompt += f"\nA previous attempt failed: {attempt_context}\n"
+    return full_prompt
+
+def split_candidates(text: str) -> List[str]:
+    found = [body for _, body in _CANDIDATE_RE.findall(text or "")]
+    # A model that ignored the markers still gave us one usable answer
+    return found or [text or ""]
+
+def try_generate_and_preview(
+    session: Session,
+    schema_card: str,
+    user_prompt: str,
+    max_attempts: int = MAX_GENERATION_ATTEMPTS,
+    complete: Optional[Callable[[str, str, str], str]] = None,
+    remember: Optional[Callable[[str, str, str, str], None]] = None,
+) -> Tuple[str, dict, List[str]]:
+    # complete(model, system, prompt) lets the UI put a memoized call in front of Cortex;
+    # remember(model, system, prompt, response) is only called for a response whose query passed
+    if complete is None:
+        complete = lambda model, system, prompt: cortex_complete(session, model, system, prompt)
+    if remember is None:
+        remember = lambda model, system, prompt, response: store_cortex_response(session, model, system, prompt, response)
+    errors: List[str] = []
+    seen_sql_hashes = set()
+    last_was_duplicate = False
+    attempt_context = ""
+    sql_text, validation = "", {}
+    # The instructions, schema card and request are identical across attempts
+    prompt_prefix = build_prompt_prefix(schema_card, user_prompt)
+    for attempt in range(max_attempts):
+        # The first call asks for several candidates at once, paying for the prompt once;
+        # retries go back to one query per call
+        candidates = CANDIDATES_PER_CALL if attempt == 0 else 1
+        system = CANDIDATES_SYSTEM_PROMPT if candidates > 1 else SYSTEM_PROMPT
+        full_prompt = build_prompt(prompt_prefix, attempt_context, candidates)
+        try:
+            res = complete(CORTEX_MODEL, system, full_prompt)
+        except Exception as e:
+            errors.append(f"Cortex call failed: {e}")
+            # Only throttling/timeouts are worth retrying, after a backoff
+            if not _TRANSIENT_RE.search(str(e)):
+                break
+            # No point waiting when no attempt follows
+            if attempt + 1 < max_attempts:
+                time.sleep(2 ** attempt)
+            continue
+
+        fresh: List[str] = []
+        for raw in split_candidates(res):
+            candidate = normalize_model_sql(raw)
+            candidate_hash = sql_fingerprint(candidate)
+            if candidate_hash not in seen_sql_hashes:
+                seen_sql_hashes.add(candidate_hash)
+                fresh.append(candidate)
+        if not fresh:
+            # Skip re-validating a known-bad answer; two repeats in a row means the model is stuck
+            errors.append("Model repeated a previous answer.")
+            if last_was_duplicate:
+                break
+            last_was_duplicate = True
+            attempt_context = f"{attempt_context} Do not repeat the previous answer; write a different query.".strip()
+            continue
+        last_was_duplicate = False
+
+        planned: List[str] = []
+        for sql_text in fresh:
+            if not is_single_select(sql_text) or not enforce_read_only(sql_text):
+                errors.append("Output was not a single read-only SELECT.")
+                attempt_context = "return exactly one read-only SELECT (or WITH ... SELECT) statement and nothing else."
+                validation = {}
+                continue
+            # str.count over the unquoted text is enough to skip a doomed EXPLAIN round-trip
+            if not analyze_sql(sql_text).balanced_parens:
+                errors.append("Output has unbalanced parentheses.")
+                attempt_context = "the query had unbalanced parentheses; close every ( with a matching )."
+                validation = {}
+                continue
+            planned.append(sql_text)
+        if not planned:
+            continue
+
+        # Candidates are independent, so their EXPLAIN/preview round-trips overlap; once one
+        # passes, the others' queries are cancelled so they stop using the warehouse
+        ex = ThreadPoolExecutor(max_workers=len(planned))
+        jobs: list = []
+        futures = {ex.submit(validate_sql, session, c, jobs): c for c in planned}
+        passed = False
+        try:
+            for fut in as_completed(futures):
+                sql_text, validation = futures[fut], fut.result()
+                failure = validation["explain_error"] or validation["preview_error"]
+                if failure is None and validation["is_select"]:
+                    passed = True
+                    break
+                failure = failure or "Snowflake did not plan the query as a single SELECT."
+                errors.append(failure)
+                if _MISSING_OBJECT_RE.search(failure):
+                    attempt_context = f"{failure} Use only the tables and columns listed above, spelled exactly as shown."
+                else:
+                    attempt_context = failure
+        finally:
+            for fut in futures:
+                fut.cancel()
+            for job in jobs:
+                try:
+                    if not job.is_done():
+                        job.cancel()
+                except Exception:
+                    pass
+            # Cancelled jobs fail fast, so this only waits for the workers to unwind
+            ex.shutdown(wait=True)
+        if passed:
+            # Only now is the response worth replaying for the same prompt
+            remember(CORTEX_MODEL, system, full_prompt, res)
+            return sql_text, validation, errors
+    return sql_text, validation, errors
 
 def insert_pipeline_config(
     session: Session,
@@ -136,57 +652,44 @@ def insert_pipeline_config(
     lag_minutes: int,
     warehouse: str,
     sql_select: str,
+    downstream_lag: bool = False,
+    refresh_mode: Optional[str] = None,
 ):
-    # Determine if TARGET_DT_SCHEMA column exists in TECHUP.DEMO.PIPELINE_CONFIG
-    has_schema_col = False
+    # Older TECHUP.DEMO.PIPELINE_CONFIG tables may lack the optional columns; one lookup finds which exist
     try:
-        chk_sql = f"select 1 from {PIPELINE_CATALOG_DB}.information_schema.columns where table_schema = '{PIPELINE_CATALOG_SCHEMA}' and table_name = 'PIPELINE_CONFIG' and column_name = 'TARGET_DT_SCHEMA'"
-        has_schema_col = len(session.sql(chk_sql).collect()) > 0
+        chk_sql = f"select column_name from {PIPELINE_CATALOG_DB}.information_schema.columns where table_schema = ? and table_name = 'PIPELINE_CONFIG' and column_name in ('TARGET_DT_SCHEMA', 'TARGET_LAG', 'REFRESH_MODE')"
+        present = {r[0] for r in session.sql(chk_sql, params=[PIPELINE_CATALOG_SCHEMA]).collect()}
     except Exception:
-        has_schema_col = False
+        present = set()
+    if downstream_lag and "TARGET_LAG" not in present:
+        raise ValueError("PIPELINE_CONFIG has no TARGET_LAG column; run the migration in sql/PIPELINE_CONFIG.sql to use DOWNSTREAM lag.")
 
     table_fqn = f"{PIPELINE_CATALOG_DB}.{PIPELINE_CATALOG_SCHEMA}.PIPELINE_CONFIG"
 
-    if has_schema_col:
-        insert_sql = f"""
-        INSERT INTO {table_fqn} (
-            transformation_sql_snippet,
-            target_dt_database,
-            target_dt_schema,
-            target_dt_name,
-            lag_minutes,
-            warehouse,
-            status
-        ) VALUES (
-            $${sql_select}$$,
-            '{target_dt_database}',
-            '{target_dt_schema}',
-            '{target_dt_name}',
-            {lag_minutes},
-            '{warehouse}',
-            'PENDING'
-        )
-        """
-    else:
-        insert_sql = f"""
+    # Values are bound, so the statement text is identical across pipelines and the
+    # SQL body is never spliced into the INSERT
+    columns = ["transformation_sql_snippet", "target_dt_database"]
+    params = [sql_select, target_dt_database]
+    if "TARGET_DT_SCHEMA" in present:
+        columns.append("target_dt_schema")
+        params.append(target_dt_schema)
+    columns += ["target_dt_name", "lag_minutes", "warehouse"]
+    params += [target_dt_name, lag_minutes, warehouse]
+    if "TARGET_LAG" in present:
+        # NULL keeps the lag_minutes schedule; DOWNSTREAM refreshes only when a consumer needs data
+        columns.append("target_lag")
+        params.append("DOWNSTREAM" if downstream_lag else None)
+    if "REFRESH_MODE" in present:
+        # NULL leaves the choice to Snowflake (AUTO)
+        columns.append("refresh_mode")
+        params.append(refresh_mode)
+    insert_sql = f"""
         INSERT INTO {table_fqn} (
-            transformation_sql_snippet,
-            target_dt_database,
-            target_dt_name,
-            lag_minutes,
-            warehouse,
+            {", ".join(columns)},
             status
-        ) VALUES (
-            $${sql_select}$$,
-            '{target_dt_database}',
-            '{target_dt_name}',
-            {lag_minutes},
-            '{warehouse}',
-            'PENDING'
-        )
+        ) VALUES ({", ".join("?" * len(params))}, 'PENDING')
         """
-
-    session.sql(insert_sql).collect()
+    session.sql(insert_sql, params=params).collect()
 
 st.set_page_config(page_title="Pipeline Factory", page_icon="🧠", layout="wide")
 
@@ -218,44 +721,113 @@ st.markdown(
 
 @st.cache_resource(show_spinner=False)
 def _get_session() -> Session:
-    return get_session()
+    session = get_session()
+    # Tag app queries once per process so they are easy to find in QUERY_HISTORY; owner's-rights
+    # apps may reject ALTER SESSION, and a missing tag must not stop the page from loading
+    try:
+        session.sql("alter session set query_tag = 'pipeline-factory-copilot'").collect()
+    except Exception:
+        pass
+    return session
 
 session = _get_session()
 
+# Catalog lookups are memoized per argument tuple so reruns and retries skip information_schema
+@st.cache_data(ttl=600, show_spinner=False)
+def _cached_catalog() -> Dict[str, List[str]]:
+    return account_catalog(_get_session())
+
+@st.cache_data(ttl=600, show_spinner=False)
+def _cached_tables(database: str, schema: str) -> List[str]:
+    return list_tables(_get_session(), database, schema)
+
+@st.cache_data(ttl=600, show_spinner=False)
+def _cached_schema_card(tables: Tuple[str, ...]) -> str:
+    return fetch_schema_card(_get_session(), list(tables))
+
+# Re-clicking Generate with the same prompt and scope answers without a Cortex round-trip.
+# Entries are (stored_at, response) and are only added once a query from the response passed
+# validation, so a bad answer is never replayed.
+@st.cache_resource(show_spinner=False)
+def _validated_responses() -> Dict[str, Tuple[float, str]]:
+    return {}
+
+def _memo_complete(model: str, system: str, prompt: str) -> str:
+    hit = _validated_responses().get(prompt_cache_key(model, system, prompt))
+    if hit is not None and time.time() - hit[0] < 3600:
+        return hit[1]
+    return cortex_complete(_get_session(), model, system, prompt)
+
+def _remember_response(model: str, system: str, prompt: str, response: str) -> None:
+    store = _validated_responses()
+    key = prompt_cache_key(model, system, prompt)
+    hit = store.get(key)
+    if hit is not None and hit[1] == response:
+        return
+    store[key] = (time.time(), response)
+    # Oldest entries go first once the store is full
+    for stale in list(store)[:-256]:
+        store.pop(stale, None)
+    store_cortex_response(_get_session(), model, system, prompt, response)
+
 st.title("🧠 Prompt → SQL → Dynamic Table")
 
 with st.expander("🧭 Scope & Options", expanded=True):
     st.caption("Choose tables to ground the model. Fewer tables = better accuracy.")
+    if st.button("🔄 Refresh metadata"):
+        # Catalog lookups are cached for 10 minutes; drop them after creating or altering objects
+        _cached_catalog.clear()
+        _cached_tables.clear()
+        _cached_schema_card.clear()
 
     # Searchable dropdowns for Database and Schema
-    db_list = get_databases(session)
+    try:
+        catalog = _cached_catalog()
+    except Exception as e:
+        # Not cached, so the next rerun tries again
+        st.error(f"Could not list databases and schemas: {e}")
+        catalog = {}
+    db_list = list(catalog)
     selected_db = st.selectbox("Database", options=db_list) if db_list else ""
-    schema_list = get_schemas(session, selected_db) if selected_db else []
+    schema_list = catalog.get(selected_db, []) if selected_db else []
     selected_schema = st.selectbox("Schema", options=schema_list) if schema_list else ""
 
-    # Multiselect for allowed tables from the selected Database/Schema
-    allowed_tables: List[str] = []
-    if selected_db and selected_schema:
-        available = list_tables(session, selected_db, selected_schema)
-        allowed_tables = st.multiselect(
-            "Allowed tables (DB.SCHEMA.TABLE)",
-            options=available,
-            default=[],
+    # Database/Schema stay live because the table list depends on them; the rest is
+    # batched in a form so edits trigger one rerun on Apply instead of one per widget
+    with st.form("scope_form"):
+        # Multiselect for allowed tables from the selected Database/Schema
+        allowed_tables: List[str] = []
+        if selected_db and selected_schema:
+            available = _cached_tables(selected_db, selected_schema)
+            allowed_tables = st.multiselect(
+                "Allowed tables (DB.SCHEMA.TABLE)",
+                options=available,
+                default=[],
+            )
+        else:
+            st.info("Select a Database and Schema to choose allowed tables.")
+
+        default_wh = st.text_input("Warehouse", value=DEFAULT_WAREHOUSE).upper()
+        target_dt_database = st.text_input("Target Dynamic Table Database (DB)").upper()
+        target_dt_schema = st.text_input("Target Dynamic Table Schema (SCHEMA)").upper()
+        target_dt_name = st.text_input("Target Dynamic Table Name (TABLE)").upper()
+        lag_minutes = st.number_input("Lag (minutes)", min_value=1, max_value=1440, value=10)
+        table_role = st.radio(
+            "Table role",
+            ["Leaf", "Intermediate"],
+            horizontal=True,
+            help="Intermediate tables use TARGET_LAG = DOWNSTREAM and refresh only when a downstream table needs them.",
         )
-    else:
-        st.info("Select a Database and Schema to choose allowed tables.")
+        st.form_submit_button("Apply Scope")
 
     allowed_tables = [t.upper() for t in allowed_tables]
 
-    default_wh = st.text_input("Warehouse", value=DEFAULT_WAREHOUSE).upper()
-    target_dt_database = st.text_input("Target Dynamic Table Database (DB)").upper()
-    target_dt_schema = st.text_input("Target Dynamic Table Schema (SCHEMA)").upper()
-    target_dt_name = st.text_input("Target Dynamic Table Name (TABLE)").upper()
-    lag_minutes = st.number_input("Lag (minutes)", min_value=1, max_value=1440, value=10)
-
 st.subheader("📝 Describe the data")
 prompt = st.text_area("Prompt", height=140, placeholder="Show the latest order per customer in the last 30 days")
 
+# A cached answer is replayed for the same prompt and scope; this forces a new COMPLETE call
+fresh_answer = st.checkbox("Ask Cortex again (skip cached answers)")
+
 if st.button("✨ Generate SQL with Cortex", type="primary"):
     if not allowed_tables:
         st.error("Please provide at least one allowed table.")
@@ -263,60 +835,73 @@ if st.button("✨ Generate SQL with Cortex", type="primary"):
         st.error("Please enter a prompt.")
     else:
         with st.spinner("Calling Cortex..."):
-            schema_card = fetch_schema_card(session, allowed_tables)
-            system = "\n".join(FEW_SHOTS)
-            full_prompt = f"""
-You are a Snowflake SQL assistant.
-Only output a single SELECT query.
-Use fully qualified identifiers. Do not include comments or extra text.
-You may only reference these tables:
-{schema_card}
-
-User request:
-{prompt}
-"""
-            # Call Cortex via SQL function COMPLETE
-            res = session.sql(
-                f"select snowflake.cortex.complete('{CORTEX_MODEL}', $$ {system}\n\n{full_prompt} $$) as c"
-            ).collect()[0][0]
-            generated_sql = res.strip().strip('`')
+            schema_card = _cached_schema_card(tuple(sorted(allowed_tables)))
+            if fresh_answer:
+                # A passing fresh answer replaces the stored one through _remember_response
+                complete = lambda model, system, p: cortex_complete(session, model, system, p, use_cache=False)
+            else:
+                complete = _memo_complete
+            generated_sql, validation, gen_errors = try_generate_and_preview(
+                session, schema_card, prompt, complete=complete, remember=_remember_response
+            )
 
-        st.code(generated_sql, language="sql")
-        st.session_state["generated_sql"] = generated_sql
-        st.success("SQL generated. Validate and preview below.")
+        for err in gen_errors:
+            st.caption(f"Attempt issue: {err}")
+        if not generated_sql:
+            st.error("Cortex did not return any SQL.")
+        else:
+            st.code(generated_sql, language="sql")
+            st.session_state["generated_sql"] = generated_sql
+            if validation:
+                # Seed the validation cache so the section below does not repeat EXPLAIN/preview
+                st.session_state["_validation_cache"] = {sql_fingerprint(generated_sql): validation}
+            st.success("SQL generated. Validate and preview below.")
 
 if "generated_sql" in st.session_state:
     sql_text = st.session_state["generated_sql"]
 
+    # Reruns (any widget interaction) reuse the EXPLAIN/preview results for unchanged SQL
+    sql_hash = sql_fingerprint(sql_text)
+    validation_cache = st.session_state.setdefault("_validation_cache", {})
+    # Snowflake round-trips only repeat on an explicit request (e.g. after grants or data change)
+    if st.button("🔄 Re-validate"):
+        validation_cache.pop(sql_hash, None)
+    if sql_hash not in validation_cache:
+        validation_cache[sql_hash] = validate_sql(session, sql_text)
+    validation = validation_cache[sql_hash]
+    is_select = validation["is_select"]
+    is_ro = validation["is_ro"]
+    explain_ok = validation["explain_error"] is None
+
     st.subheader("✅ Validation")
     col1, col2 = st.columns(2)
     with col1:
-        is_select = is_single_select(sql_text)
-        is_ro = enforce_read_only(sql_text)
         st.write(f"Single SELECT: {'✅' if is_select else '❌'}")
         st.write(f"Read-only: {'✅' if is_ro else '❌'}")
     with col2:
-        try:
-            plan = explain_query(session, sql_text)
-            st.text_area("EXPLAIN USING TEXT", plan, height=180)
-            explain_ok = True
-        except Exception as e:
-            st.error(f"Explain failed: {e}")
-            explain_ok = False
+        if explain_ok:
+            st.text_area("EXPLAIN USING TABULAR", validation["plan"], height=180)
+        else:
+            st.error(f"Explain failed: {validation['explain_error']}")
 
     st.subheader("👀 Preview")
     preview_ok = False
     if is_select and is_ro and explain_ok:
-        try:
-            pdf = preview_query(session, sql_text, limit=PREVIEW_LIMIT)
-            st.dataframe(pdf, use_container_width=True)
+        if validation["preview_error"] is None:
+            st.dataframe(validation["preview"], use_container_width=True)
             preview_ok = True
-        except Exception as e:
-            st.error(f"Preview failed: {e}")
+        else:
+            st.error(f"Preview failed: {validation['preview_error']}")
 
     st.subheader("🚀 Create Pipeline")
     if not (target_dt_database and target_dt_schema and target_dt_name):
         st.info("Enter the target Dynamic Table database, schema, and table name above.")
+    blockers = incremental_blockers(sql_text)
+    if blockers:
+        st.warning(
+            f"Incremental refresh is not supported for {', '.join(blockers)}; "
+            "the Dynamic Table will use REFRESH_MODE = AUTO and may fully refresh."
+        )
     can_create = is_select and is_ro and explain_ok and preview_ok and bool(target_dt_database) and bool(target_dt_schema) and bool(target_dt_name)
 
     if st.button("➕ Insert into PIPELINE_CONFIG (PENDING)", disabled=not can_create):
@@ -329,6 +914,8 @@ if "generated_sql" in st.session_state:
                 lag_minutes=int(lag_minutes),
                 warehouse=default_wh,
                 sql_select=sql_text,
+                downstream_lag=table_role == "Intermediate",
+                refresh_mode=None if blockers else "INCREMENTAL",
             )
             st.success("Inserted. The orchestrator will create the Dynamic Table shortly.")
             st.balloons()
@@ -0,0 +1,8 @@
+-- CORTEX_PROMPT_CACHE table DDL (exact-match cache of Cortex COMPLETE responses that produced a valid query)
+-- Location must match PIPELINE_CATALOG_DB/PIPELINE_CATALOG_SCHEMA in app.py; expired rows are deleted by the app
+create table if not exists TECHUP.DEMO.CORTEX_PROMPT_CACHE (
+  key         varchar           not null,
+  model       varchar           not null,
+  response    varchar(16777216) not null,
+  created_at  timestamp_ltz     default current_timestamp()
+);
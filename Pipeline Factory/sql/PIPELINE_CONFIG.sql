@@ -6,6 +6,13 @@ create or replace table PIPELINE_CONFIG (
   target_dt_name             varchar           not null,
   lag_minutes                number(10,0)      not null,
   warehouse                  varchar           not null,
+  target_lag                 varchar,          -- NULL = lag_minutes; DOWNSTREAM for intermediate tables
+  refresh_mode               varchar,          -- NULL = AUTO; INCREMENTAL/FULL pin a mode
   status                     varchar           not null,
   created_at                 timestamp_ltz     default current_timestamp()
 );
+
+-- Migration for PIPELINE_CONFIG tables created before target_lag/refresh_mode existed
+-- (run these instead of the create above to keep existing rows)
+alter table if exists PIPELINE_CONFIG add column if not exists target_lag varchar;
+alter table if exists PIPELINE_CONFIG add column if not exists refresh_mode varchar;
@@ -19,22 +19,28 @@ def quote_identifier(identifier: str) -> str:
         quoted_parts.append(''"'' + p_safe + ''"'')
     return ''.''.join(quoted_parts)
 
-def quote_literal(value: str) -> str:
-    return "''" + value.replace("''", "''''") + "''"
-
 def build_select_sql(snippet: str) -> str:
     s = (snippet or "").strip()
     return s
 
+OPTIONAL_COLUMNS = ("TARGET_LAG", "REFRESH_MODE")
+
 def run(session: Session) -> str:
-    rows: List = session.sql("""
+    # Older PIPELINE_CONFIG tables may lack the optional columns; select only those that exist
+    present = set()
+    for c in session.sql("show columns in table PIPELINE_CONFIG").collect():
+        d = c.as_dict()
+        present.add((d.get("column_name", d.get("COLUMN_NAME")) or "").upper())
+    optional = "".join(", " + c.lower() for c in OPTIONAL_COLUMNS if c in present)
+
+    rows: List = session.sql(f"""
         select
           transformation_sql_snippet,
           target_dt_database,
           target_dt_schema,
           target_dt_name,
           lag_minutes,
-          warehouse
+          warehouse{optional}
         from PIPELINE_CONFIG
         where status = ''PENDING''
         order by target_dt_name
@@ -45,14 +51,18 @@ def run(session: Session) -> str:
 
     created = 0
     messages = []
+    failed = []
 
-    for r in rows:
+    for row in rows:
+        r = row.as_dict()
         snippet = r[''TRANSFORMATION_SQL_SNIPPET'']
         target_dt_database = r[''TARGET_DT_DATABASE'']
         target_dt_schema = r[''TARGET_DT_SCHEMA'']
         target_dt_name = r[''TARGET_DT_NAME'']
         lag_minutes = int(r[''LAG_MINUTES''])
         warehouse = r[''WAREHOUSE'']
+        target_lag = r.get(''TARGET_LAG'')
+        refresh_mode = (r.get(''REFRESH_MODE'') or "").upper()
 
         q_db = quote_identifier(target_dt_database)
         q_schema = quote_identifier(target_dt_schema)
@@ -62,21 +72,55 @@ def run(session: Session) -> str:
 
         select_sql = build_select_sql(snippet)
 
-        dt_sql = f"""
+        # Intermediate tables refresh only when a downstream dynamic table needs fresh data
+        if (target_lag or "").upper() == "DOWNSTREAM":
+            lag_clause = "target_lag = downstream"
+        else:
+            lag_clause = f"target_lag = ''{lag_minutes} minutes''"
+        # Only known keywords are spliced into the DDL; otherwise Snowflake picks (AUTO)
+        refresh_clause = f"refresh_mode = {refresh_mode.lower()}" if refresh_mode in ("INCREMENTAL", "FULL", "AUTO") else ""
+
+        # on_schedule returns as soon as the table is defined instead of running the first
+        # refresh inside CREATE, so one heavy pipeline no longer stalls the rest of the batch
+        def dt_sql(refresh: str) -> str:
+            return f"""
 create or replace dynamic table {q_target}
 warehouse = {q_wh}
-lag = ''{lag_minutes} minutes''
+{lag_clause}
+{refresh}
+initialize = on_schedule
 as
 {select_sql}
 """
-        session.sql(dt_sql).collect()
+
+        # A failed CREATE must not stop the batch or leave the row PENDING for every later run
+        status = ''ACTIVE''
+        try:
+            session.sql(dt_sql(refresh_clause)).collect()
+        except Exception as e:
+            error = e
+            if refresh_clause:
+                # The requested refresh mode may not fit the query; let Snowflake choose instead
+                try:
+                    session.sql(dt_sql("")).collect()
+                    error = None
+                except Exception as e2:
+                    error = e2
+            if error is not None:
+                status = ''FAILED''
+                failed.append(f"{target_dt_name} ({error})")
 
         session.sql(
-            f"update PIPELINE_CONFIG set status = ''ACTIVE'' where target_dt_database = {quote_literal(target_dt_database)} and target_dt_schema = {quote_literal(target_dt_schema)} and target_dt_name = {quote_literal(target_dt_name)}"
+            "update PIPELINE_CONFIG set status = ? where target_dt_database = ? and target_dt_schema = ? and target_dt_name = ? and status = ''PENDING''",
+            params=[status, target_dt_database, target_dt_schema, target_dt_name],
         ).collect()
 
-        created += 1
-        messages.append(f"{target_dt_name}")
+        if status == ''ACTIVE'':
+            created += 1
+            messages.append(f"{target_dt_name}")
 
-    return f"Created/updated {created} dynamic table(s): " + ", ".join(messages)
+    result = f"Created/updated {created} dynamic table(s): " + ", ".join(messages)
+    if failed:
+        result += f". Failed {len(failed)}: " + "; ".join(failed)
+    return result
 ';
\ No newline at end of file